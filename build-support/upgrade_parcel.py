@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# This script upgrades the Kudu parcel on a cluster managed by Cloudera
+# Manager. It finds the best upgrade candidate among the parcels known to
+# the cluster (same release version as the currently activated parcel, but
+# a greater build number), drives it through the download, distribution,
+# and activation stages, restarts the Kudu service, and can optionally
+# remove the now-stale parcels afterwards.
+#
+# Requires the cm_api Python client:
+#   https://cloudera.github.io/cm_api/
+
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+
+# time.monotonic is immune to wall-clock jumps but only exists on Python 3.
+try:
+  from time import monotonic as _monotonic
+except ImportError:
+  from time import time as _monotonic
+
+from cm_api.api_client import ApiException, ApiResource
+
+from kudu_util import init_logging
+
+
+class _ReadThroughCache(object):
+  """
+  Memoizes read-only Cloudera Manager API calls for a short TTL and falls
+  back to the last successful result when a refresh fails. Polling loops
+  thereby absorb transient errors (e.g. a momentary 5xx mid-download)
+  instead of aborting the whole upgrade, and back-to-back reads of the
+  same object within the TTL reuse one HTTP response.
+  """
+  def __init__(self, ttl=2.0):
+    self._ttl = ttl
+    # (method name, args) -> (fetch time, value)
+    self._entries = {}
+
+  def call(self, method, *args):
+    key = (method.__name__,) + args
+    entry = self._entries.get(key)
+    now = _monotonic()
+    if entry is not None and now - entry[0] < self._ttl:
+      return entry[1]
+    try:
+      value = method(*args)
+    except Exception as e:
+      if entry is None:
+        raise
+      logging.warning("%s%s failed (%s); reusing the last successful result",
+                      method.__name__, args, e)
+      return entry[1]
+    self._entries[key] = (now, value)
+    return value
+
+
+# Shared by all read-side Cloudera Manager calls below.
+_api_cache = _ReadThroughCache()
+
+
+def get_build_number(parcel):
+  """ Return the trailing build number of 'parcel' as an integer. """
+  # Parcel versions look like "1.4.0-1.cdh5.12.0.p0.814": the Kudu release
+  # version, the CDH version the parcel was built against, and a trailing
+  # patch level and build number. Plain string splits are considerably
+  # faster than the regexes this used to run on every parcel.
+  build = parcel.version.rsplit(".", 1)[-1]
+  if not build.isdigit():
+    raise Exception("Could not parse build number from parcel version '%s'" %
+                    parcel.version)
+  return int(build)
+
+
+def get_release_version(full_version):
+  """ Return the release version (e.g. "1.4.0") of a full parcel version. """
+  release = full_version.split("-", 1)[0]
+  if release.count(".") != 2:
+    raise Exception("Could not parse release version from parcel version '%s'" %
+                    full_version)
+  return release
+
+
+def get_best_upgrade_candidate_parcel(all_parcels, parcel_name):
+  """
+  Return the best parcel among 'all_parcels' to upgrade to, or None if there
+  is no suitable candidate. The best candidate will be the one with the
+  greatest build number among the parcels sharing the release version of the
+  currently activated parcel.
+  """
+  # Keep a running best instead of materializing per-stage parcel lists.
+  # Cloudera Manager allows only one activated parcel per product, but the
+  # API does not guarantee it, so track a running max rather than stopping
+  # at the first activated parcel.
+  greatest_activated = None
+  activated_build = None
+  for parcel in all_parcels:
+    if parcel.product != parcel_name or parcel.stage != "ACTIVATED":
+      continue
+    build = get_build_number(parcel)
+    if greatest_activated is None or build > activated_build:
+      greatest_activated = parcel
+      activated_build = build
+  if greatest_activated is None:
+    logging.info("No activated %s parcel found; nothing to upgrade", parcel_name)
+    return None
+  activated_release = get_release_version(greatest_activated.version)
+
+  best_candidate = None
+  best_candidate_build = None
+  for parcel in all_parcels:
+    if parcel.product != parcel_name or parcel.stage == "ACTIVATED":
+      continue
+    if get_release_version(parcel.version) != activated_release:
+      continue
+    build = get_build_number(parcel)
+    if build <= activated_build:
+      continue
+    # Compare parsed build numbers, not version strings: lexicographically
+    # "...p0.9" sorts above "...p0.814".
+    if best_candidate is None or build > best_candidate_build:
+      best_candidate = parcel
+      best_candidate_build = build
+  return best_candidate
+
+
+def wait_for_parcel_stage(cluster, parcel, stage, max_time):
+  """
+  Wait up to 'max_time' seconds for 'parcel' to reach 'stage', polling
+  Cloudera Manager with exponential backoff. Returns the freshly fetched
+  parcel so callers can inspect its state without another round-trip.
+  Raises if the parcel reports an error or the time budget runs out.
+  """
+  # Downloads and distributions can take minutes, so back off from a
+  # 1-second poll interval up to 10 seconds rather than hammering the
+  # Cloudera Manager server once a second for the whole wait.
+  deadline = _monotonic() + max_time
+  delay = 1.0
+  while _monotonic() < deadline:
+    target_parcel = _api_cache.call(cluster.get_parcel,
+                                    parcel.product, parcel.version)
+    if target_parcel.stage == stage:
+      return target_parcel
+    if target_parcel.state.errors:
+      raise Exception("Parcel %s-%s reported errors: %s" %
+                      (parcel.product, parcel.version, target_parcel.state.errors))
+    logging.info("Waiting for parcel %s-%s to reach stage %s (progress: %s/%s)",
+                 parcel.product, parcel.version, stage,
+                 target_parcel.state.progress, target_parcel.state.totalProgress)
+    time.sleep(min(delay, max(deadline - _monotonic(), 0)))
+    delay = min(delay * 1.5, 10.0)
+  raise Exception("Parcel %s-%s did not reach stage %s within %d seconds" %
+                  (parcel.product, parcel.version, stage, max_time))
+
+
+def ensure_parcel_activated(cluster, parcel, max_time_per_stage, dry_run):
+  """
+  Drive 'parcel' through the download, distribution, and activation stages,
+  starting from whatever stage it is currently in.
+  """
+  # The caller's view of the stage may be stale (e.g. the parcel was
+  # downloaded out-of-band since the manifest was fetched), so refresh it
+  # once up front. Each wait below returns the freshly fetched parcel, so
+  # subsequent blocks check the stage in memory instead of paying another
+  # round-trip for a no-op state change.
+  parcel = _api_cache.call(cluster.get_parcel, parcel.product, parcel.version)
+  parcel_stage = parcel.stage
+  if parcel_stage == "ACTIVATED":
+    logging.info("Parcel %s-%s is already activated", parcel.product, parcel.version)
+    return
+  if dry_run:
+    logging.info("Dry run: would activate parcel %s-%s (currently %s)",
+                 parcel.product, parcel.version, parcel_stage)
+    return
+  if parcel_stage == "AVAILABLE_REMOTELY":
+    logging.info("Downloading parcel %s-%s...", parcel.product, parcel.version)
+    parcel.start_download()
+    parcel_stage = wait_for_parcel_stage(cluster, parcel, "DOWNLOADED",
+                                         max_time_per_stage).stage
+  if parcel_stage == "DOWNLOADED":
+    logging.info("Distributing parcel %s-%s...", parcel.product, parcel.version)
+    parcel.start_distribution()
+    parcel_stage = wait_for_parcel_stage(cluster, parcel, "DISTRIBUTED",
+                                         max_time_per_stage).stage
+  if parcel_stage == "DISTRIBUTED":
+    logging.info("Activating parcel %s-%s...", parcel.product, parcel.version)
+    parcel.activate()
+    wait_for_parcel_stage(cluster, parcel, "ACTIVATED", max_time_per_stage)
+  logging.info("Parcel %s-%s is activated", parcel.product, parcel.version)
+
+
+def wait_for_parcels_stages(cluster, parcels_and_stages, max_time):
+  """
+  Wait up to 'max_time' seconds for every (parcel, target stage) pair in
+  'parcels_and_stages' to be reached, polling Cloudera Manager with
+  exponential backoff. Each poll issues a single get_all_parcels() call
+  covering all in-flight parcels rather than one get_parcel() call per
+  parcel. Raises if any parcel reports an error or the time budget runs
+  out.
+  """
+  pending = dict(((p.product, p.version), stage)
+                 for p, stage in parcels_and_stages)
+  deadline = _monotonic() + max_time
+  delay = 1.0
+  while pending:
+    for parcel in _api_cache.call(cluster.get_all_parcels):
+      target = pending.get((parcel.product, parcel.version))
+      if target is None:
+        continue
+      if parcel.stage == target:
+        del pending[(parcel.product, parcel.version)]
+        continue
+      if parcel.state.errors:
+        raise Exception("Parcel %s-%s reported errors: %s" %
+                        (parcel.product, parcel.version, parcel.state.errors))
+      logging.info("Waiting for parcel %s-%s to reach stage %s (progress: %s/%s)",
+                   parcel.product, parcel.version, target,
+                   parcel.state.progress, parcel.state.totalProgress)
+    if not pending:
+      return
+    if _monotonic() >= deadline:
+      raise Exception("Parcels %s did not reach their target stages within "
+                      "%d seconds" % (sorted(pending), max_time))
+    time.sleep(min(delay, max(deadline - _monotonic(), 0)))
+    delay = min(delay * 1.5, 10.0)
+
+
+def ensure_parcels_removed(cluster, parcels, max_time_per_stage, dry_run):
+  """
+  Remove inactive 'parcels' from the cluster: undistribute them from the
+  hosts, then delete the downloaded copies from the Cloudera Manager host.
+  The parcels advance through each removal step together, so every poll
+  covers all of them at once.
+  """
+  # The caller's view of the parcels may predate the upgrade (the previously
+  # activated parcel is deactivated when the new one is activated), so
+  # refresh their stages before deciding which steps remain.
+  parcels = [_api_cache.call(cluster.get_parcel, p.product, p.version)
+             for p in parcels]
+  if dry_run:
+    for parcel in parcels:
+      logging.info("Dry run: would remove parcel %s-%s (currently %s)",
+                   parcel.product, parcel.version, parcel.stage)
+    return
+  distributed = [p for p in parcels if p.stage == "DISTRIBUTED"]
+  for parcel in distributed:
+    logging.info("Undistributing parcel %s-%s...", parcel.product, parcel.version)
+    parcel.start_removal_of_distribution()
+  if distributed:
+    wait_for_parcels_stages(cluster, [(p, "DOWNLOADED") for p in distributed],
+                            max_time_per_stage)
+  downloaded = [p for p in parcels if p.stage in ("DISTRIBUTED", "DOWNLOADED")]
+  for parcel in downloaded:
+    logging.info("Removing downloaded parcel %s-%s...", parcel.product, parcel.version)
+    parcel.remove_download()
+  if downloaded:
+    wait_for_parcels_stages(cluster,
+                            [(p, "AVAILABLE_REMOTELY") for p in downloaded],
+                            max_time_per_stage)
+  for parcel in parcels:
+    logging.info("Parcel %s-%s is removed", parcel.product, parcel.version)
+
+
+def find_service(cluster, service_name):
+  """
+  Return the service on 'cluster' named 'service_name', matching either the
+  service name or its display name.
+  """
+  # Try a direct single-object fetch first; this avoids transferring the
+  # full service list when the name matches (the common case).
+  try:
+    return cluster.get_service(service_name)
+  except ApiException:
+    pass
+  # Fall back to scanning display names, which need not equal the service
+  # name.
+  for service in cluster.get_all_services():
+    if service.displayName == service_name:
+      return service
+  raise Exception("Could not find service '%s' on cluster '%s'" %
+                  (service_name, cluster.name))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Upgrade the Kudu parcel on a Cloudera Manager-managed cluster")
+  parser.add_argument("--host", required=True,
+                      help="Hostname of the Cloudera Manager server")
+  parser.add_argument("--user", default="admin",
+                      help="Cloudera Manager username")
+  parser.add_argument("--password", default="admin",
+                      help="Cloudera Manager password")
+  parser.add_argument("--cluster",
+                      help="Name of the cluster to upgrade; may be omitted if "
+                           "Cloudera Manager manages exactly one cluster")
+  parser.add_argument("--parcel", default="KUDU",
+                      help="Product name of the parcel to upgrade")
+  parser.add_argument("--service", default="Kudu",
+                      help="Display name of the service to restart after activation")
+  parser.add_argument("--max-time-per-stage", type=int, default=1800,
+                      help="Maximum time in seconds to wait for each parcel stage")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="Log what would be done without changing any state")
+  parser.add_argument("--clear-after-success", action="store_true",
+                      help="Remove inactive parcels after a successful upgrade")
+  args = parser.parse_args()
+
+  api = ApiResource(args.host, username=args.user, password=args.password)
+  if args.cluster:
+    cluster = api.get_cluster(args.cluster)
+  else:
+    clusters = api.get_all_clusters()
+    if len(clusters) != 1:
+      raise Exception("--cluster is required when Cloudera Manager manages "
+                      "more than one cluster")
+    cluster = clusters[0]
+
+  # Fetch the parcel manifest once; it is reused by the clear-after-success
+  # path below rather than re-fetched from Cloudera Manager.
+  all_parcels = _api_cache.call(cluster.get_all_parcels)
+  candidate = get_best_upgrade_candidate_parcel(all_parcels, args.parcel)
+  if candidate is None:
+    logging.info("No upgrade candidate parcel found for %s", args.parcel)
+    return
+  logging.info("Upgrading %s to %s", args.parcel, candidate.version)
+  ensure_parcel_activated(cluster, candidate, args.max_time_per_stage,
+                          args.dry_run)
+
+  service = find_service(cluster, args.service)
+  if args.dry_run:
+    logging.info("Dry run: would restart service %s", service.name)
+  else:
+    logging.info("Restarting service %s...", service.name)
+    service.restart().wait()
+
+  if args.clear_after_success:
+    inactive_parcels = [p for p in all_parcels
+                        if p.product == args.parcel and
+                           p.version != candidate.version and
+                           p.stage != "AVAILABLE_REMOTELY"]
+    if inactive_parcels:
+      ensure_parcels_removed(cluster, inactive_parcels, args.max_time_per_stage,
+                             args.dry_run)
+
+
+if __name__ == "__main__":
+  init_logging()
+  main()